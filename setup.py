@@ -27,11 +27,14 @@ setup(
     install_requires=[
         'setuptools',
         'Flask',
+        'msgpack',
     ],
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     cron = presence_analyzer.script:update_user_details
+    loadtest = presence_analyzer.loadtest:run
+    partition = presence_analyzer.script:partition_data
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
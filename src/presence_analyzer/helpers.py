@@ -2,3 +2,91 @@
 """
 Helper functions used in templates.
 """
+
+import os
+import hashlib
+import mimetypes
+
+from flask import Response, request
+
+from presence_analyzer.main import app
+from presence_analyzer.utils import COMPRESSORS
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+STATIC_MAX_AGE = 365 * 24 * 3600
+COMPRESSIBLE = ('text/css', 'application/javascript', 'text/javascript')
+
+
+def build_static_assets(folder):
+    """
+    Reads static files and names them with their content hash.
+
+    It creates structures like this:
+    manifest = {
+        'css/style.css': 'css/style.0123456789ab.css',
+    }
+    assets = {
+        'css/style.0123456789ab.css': {
+            'identity': 'body {...}',
+            'gzip': '...',
+        }
+    }
+    """
+    manifest = {}
+    assets = {}
+    for root, _, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, folder).replace(os.sep, '/')
+            with open(path, 'rb') as static_file:
+                content = static_file.read()
+            base, ext = os.path.splitext(filename)
+            hashed = '%s.%s%s' % (
+                base, hashlib.md5(content).hexdigest()[:12], ext
+            )
+            manifest[filename] = hashed
+            assets[hashed] = {'identity': content}
+            if mimetypes.guess_type(filename)[0] in COMPRESSIBLE:
+                for encoding, compress in COMPRESSORS.items():
+                    assets[hashed][encoding] = compress(content)
+    return manifest, assets
+
+
+STATIC_MANIFEST, STATIC_ASSETS = build_static_assets(app.static_folder)
+
+
+@app.url_defaults
+def hashed_static_url(endpoint, values):
+    """
+    Points static URLs to fingerprinted file names outside debug mode.
+    """
+    if endpoint == 'static' and not app.debug:
+        filename = values.get('filename')
+        values['filename'] = STATIC_MANIFEST.get(filename, filename)
+
+
+def static_view(filename):
+    """
+    Serves fingerprinted static files with long cache headers.
+    """
+    asset = STATIC_ASSETS.get(filename)
+    if asset is None:
+        return app.send_static_file(filename)
+
+    encoding = request.accept_encodings.best_match(
+        [i for i in asset if i != 'identity'], 'identity'
+    )
+    response = Response(asset[encoding],
+                        mimetype=mimetypes.guess_type(filename)[0])
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = (
+        'public, max-age=%d, immutable' % STATIC_MAX_AGE
+    )
+    return response
+
+
+app.view_functions['static'] = static_view
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+Load test simulating the morning burst of chart page visitors.
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+import urllib2
+from datetime import date, datetime, timedelta
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+# chart pages and statistics endpoint each of them calls
+CHART_PAGES = {
+    'presenceweekday': 'presence_weekday',
+    'meantime': 'mean_time_weekday',
+    'presencestartend': 'presence_start_end',
+}
+STATIC_URL = re.compile(r'(?:src|href)="(/static/[^"]+)"')
+EXPIRE_PATH = '/_loadtest/expire'
+
+
+def generate_data(directory, users, days, seed=0):
+    """
+    Writes synthetic presence CSV and users XML, returns their paths.
+
+    Files are replaced atomically, so running server never reads them
+    half written.
+    """
+    rand = random.Random(seed)
+    csv_path = os.path.join(directory, 'presence.csv')
+    xml_path = os.path.join(directory, 'users.xml')
+    first_day = date(2013, 1, 1)
+    with open(csv_path + '.tmp', 'w') as csvfile:
+        csvfile.write('user_id,date,start,end\n')
+        for day in range(days):
+            current = first_day + timedelta(days=day)
+            if current.weekday() > 4:
+                continue
+            for user_id in range(1, users + 1):
+                if rand.random() < 0.1:
+                    continue
+                start = rand.randint(7 * 3600, 11 * 3600)
+                end = start + rand.randint(4 * 3600, 10 * 3600)
+                csvfile.write('%d,%s,%s,%s\n' % (
+                    user_id, current.isoformat(),
+                    format_seconds(start), format_seconds(min(end, 86399)),
+                ))
+    with open(xml_path + '.tmp', 'w') as xmlfile:
+        xmlfile.write('<?xml version="1.0" encoding="UTF-8" ?>\n')
+        xmlfile.write('<intranet><users>\n')
+        for user_id in range(1, users + 1):
+            xmlfile.write(
+                '<user id="%d"><avatar>/api/images/users/%d</avatar>'
+                '<name>User %d</name></user>\n' % (user_id, user_id, user_id)
+            )
+        xmlfile.write('</users></intranet>\n')
+    os.rename(csv_path + '.tmp', csv_path)
+    os.rename(xml_path + '.tmp', xml_path)
+    return csv_path, xml_path
+
+
+def format_seconds(seconds):
+    """
+    Formats seconds since midnight as HH:MM:SS.
+    """
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                               seconds % 60)
+
+
+def expiring(app):
+    """
+    Wraps application with endpoint forcing presence data reload.
+    """
+    def middleware(environ, start_response):
+        """
+        Expires presence data cache on EXPIRE_PATH requests.
+        """
+        if environ.get('PATH_INFO') != EXPIRE_PATH:
+            return app(environ, start_response)
+        from presence_analyzer.utils import get_data
+        get_data.cache[0] = datetime.min
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['expired']
+    return middleware
+
+
+def serve(options):
+    """
+    Serves application with paste threadpool server like `paster serve`.
+
+    Runs in separate process started by `start_server` with `--serve`.
+    """
+    from paste import httpserver
+    from presence_analyzer import app
+    from presence_analyzer.utils import warm_up
+    app.config.update({'DATA_CSV': options.csv, 'DATA_XML': options.xml})
+    warm_up()
+    httpserver.serve(
+        expiring(app), host='127.0.0.1', port=options.port,
+        use_threadpool=True, threadpool_workers=options.workers,
+        threadpool_options={
+            'spawn_if_under': options.spawn_if_under,
+            'max_requests': options.max_requests,
+        },
+    )
+
+
+def start_server(options, csv_path, xml_path):
+    """
+    Starts server process and waits until its data is loaded.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    server = subprocess.Popen([
+        sys.executable, '-m', 'presence_analyzer.loadtest', '--serve',
+        '--csv', csv_path, '--xml', xml_path,
+        '--port', str(options.port),
+        '--workers', str(options.workers),
+        '--spawn-if-under', str(options.spawn_if_under),
+        '--max-requests', str(options.max_requests),
+    ], env=env)
+    ready_url = 'http://127.0.0.1:%d/health/ready' % options.port
+    deadline = time.time() + 60
+    while time.time() < deadline and server.poll() is None:
+        try:
+            urllib2.urlopen(ready_url, timeout=5).read()
+            return server
+        except (urllib2.URLError, IOError):
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('Server did not become ready')
+
+
+class Recorder(object):
+    """
+    Thread safe collector of request latencies grouped by endpoint.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, endpoint, seconds, ok):
+        """
+        Saves latency of single request.
+        """
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def merge(self, latencies, errors):
+        """
+        Adds latencies and errors collected by other recorder.
+        """
+        with self.lock:
+            for endpoint, items in latencies.items():
+                self.latencies.setdefault(endpoint, []).extend(items)
+            for endpoint, count in errors.items():
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + count
+
+    def report(self, elapsed, out=sys.stdout):
+        """
+        Prints throughput and latency percentiles of each endpoint.
+        """
+        out.write('%-22s %8s %6s %9s %8s %8s %8s %8s\n' % (
+            'endpoint', 'requests', 'errors', 'req/s',
+            'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+        ))
+        total = 0
+        for endpoint in sorted(self.latencies):
+            latencies = sorted(self.latencies[endpoint])
+            total += len(latencies)
+            out.write('%-22s %8d %6d %9.1f %8.1f %8.1f %8.1f %8.1f\n' % (
+                (endpoint, len(latencies), self.errors.get(endpoint, 0),
+                 len(latencies) / elapsed) +
+                tuple(1000 * percentile(latencies, i) for i in (50, 90, 99)) +
+                (1000 * latencies[-1],)
+            ))
+        out.write('%-22s %8d %6d %9.1f\n' % (
+            'total', total, sum(self.errors.values()), total / elapsed
+        ))
+
+
+def percentile(items, percent):
+    """
+    Returns nearest-rank percentile of sorted list.
+    """
+    if not items:
+        return 0
+    rank = int(round(percent / 100.0 * (len(items) - 1)))
+    return items[rank]
+
+
+def visitor(base_url, recorder, deadline, seed, user_ids):
+    """
+    Simulates visitor opening chart pages and statistics of users on them.
+
+    Fingerprinted static files are fetched once, like browser cache does.
+    """
+    rand = random.Random(seed)
+    cached = set()
+
+    def fetch(endpoint, path):
+        request = urllib2.Request(base_url + path,
+                                  headers={'Accept-Encoding': 'gzip'})
+        started = time.time()
+        try:
+            body = urllib2.urlopen(request, timeout=30).read()
+        except (urllib2.URLError, IOError):
+            log.debug('Request %s failed', path, exc_info=True)
+            body = None
+        recorder.record(endpoint, time.time() - started, body is not None)
+        return body
+
+    while time.time() < deadline:
+        page = rand.choice(sorted(CHART_PAGES))
+        html = fetch('chart', '/chart/%s' % page)
+        for path in STATIC_URL.findall(html or ''):
+            if path not in cached:
+                fetch('static', path)
+                cached.add(path)
+        for _ in range(rand.randint(1, 5)):
+            if time.time() >= deadline:
+                break
+            endpoint = CHART_PAGES[page]
+            fetch(endpoint, '/api/v1/%s/%d' % (endpoint,
+                                                rand.choice(user_ids)))
+
+
+def run_clients(args):
+    """
+    Runs visitors in threads of client process, returns their latencies.
+    """
+    base_url, deadline, seeds, user_ids = args
+    recorder = Recorder()
+    clients = [
+        threading.Thread(target=visitor, args=(
+            base_url, recorder, deadline, seed, user_ids
+        ))
+        for seed in seeds
+    ]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    return recorder.latencies, recorder.errors
+
+
+def load_test(options):
+    """
+    Runs load test and prints its report.
+
+    Server and clients run in separate processes, so clients do not
+    compete with server for the interpreter lock.
+    """
+    directory = tempfile.mkdtemp(prefix='presence-loadtest-')
+    server = None
+    try:
+        csv_path, xml_path = generate_data(directory, options.users,
+                                           options.days, options.seed)
+        server = start_server(options, csv_path, xml_path)
+        base_url = 'http://127.0.0.1:%d' % options.port
+        user_ids = range(1, options.users + 1)
+        recorder = Recorder()
+        started = time.time()
+        deadline = started + options.duration
+        seeds = range(options.seed, options.seed + options.clients)
+        processes = max(1, min(options.processes, options.clients))
+        pool = multiprocessing.Pool(processes)
+        results = pool.map_async(run_clients, [
+            (base_url, deadline, seeds[i::processes], user_ids)
+            for i in range(processes)
+        ])
+
+        # cache expiry in first third, data reload in second third
+        time.sleep(options.duration / 3.0)
+        log.info('Expiring presence data cache')
+        urllib2.urlopen(base_url + EXPIRE_PATH).read()
+        time.sleep(options.duration / 3.0)
+        log.info('Reloading presence data')
+        generate_data(directory, options.users, options.days + 7,
+                      options.seed + 1)
+        urllib2.urlopen(base_url + EXPIRE_PATH).read()
+
+        for latencies, errors in results.get():
+            recorder.merge(latencies, errors)
+        pool.close()
+        pool.join()
+        recorder.report(time.time() - started)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(directory)
+
+
+def run(argv=None):
+    """
+    Parses command line options and runs load test.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--clients', type=int, default=50,
+                        help='concurrent visitors')
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='client processes running visitors')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='test duration in seconds')
+    parser.add_argument('--users', type=int, default=200,
+                        help='synthetic users')
+    parser.add_argument('--days', type=int, default=365,
+                        help='synthetic days of presence')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=50)
+    parser.add_argument('--spawn-if-under', type=int, default=5)
+    parser.add_argument('--max-requests', type=int, default=200)
+    # server process mode used by `start_server`
+    parser.add_argument('--serve', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--csv', help=argparse.SUPPRESS)
+    parser.add_argument('--xml', help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+    if options.serve:
+        logging.basicConfig(level=logging.WARNING)
+        serve(options)
+    else:
+        logging.basicConfig(level=logging.INFO)
+        load_test(options)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Sampling profiler middleware.
+"""
+
+import os
+import hmac
+import time
+import atexit
+import random
+import pstats
+import cProfile
+import threading
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+UNMATCHED = 'unmatched'  # key of requests not matching any URL rule
+
+
+class SamplingProfiler(object):
+    """
+    WSGI middleware profiling sampled requests and requests with token.
+
+    Profiles are aggregated by matched endpoint of `url_map` and flushed
+    to `directory` as `profile-<endpoint>.prof` files readable with
+    `pstats` or tools like snakeviz and gprof2dot. Flush happens every
+    `flush_every` profiles, after `flush_interval` seconds, at exit and
+    immediately for requests with token.
+    """
+
+    def __init__(self, app, url_map, directory, rate=0.0, token=None,
+                 flush_every=100, flush_interval=60):
+        self.app = app
+        self.url_map = url_map
+        self.directory = directory
+        self.rate = rate
+        self.token = token
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.dirty = set()
+        self.pending = 0
+        self.flushed = time.time()
+        atexit.register(self.flush)
+
+    def __call__(self, environ, start_response):
+        sampled, token = self.sampled(environ)
+        if not sampled:
+            return self.app(environ, start_response)
+
+        profile = cProfile.Profile()
+        body = profile.runcall(self.respond, environ, start_response)
+        self.save(self.endpoint(environ), profile, flush=token)
+        return body
+
+    def sampled(self, environ):
+        """
+        Decides whether request should be profiled and if it has token.
+        """
+        header = environ.get(PROFILE_HEADER)
+        token = bool(self.token and header and
+                     hmac.compare_digest(header, self.token))
+        return token or bool(self.rate and random.random() < self.rate), token
+
+    def endpoint(self, environ):
+        """
+        Returns endpoint of URL rule matching request.
+        """
+        try:
+            endpoint, _ = self.url_map.bind_to_environ(environ).match()
+        except (HTTPException, RequestRedirect):
+            return UNMATCHED
+        return endpoint
+
+    def respond(self, environ, start_response):
+        """
+        Calls application and consumes its response body.
+        """
+        iterable = self.app(environ, start_response)
+        try:
+            return list(iterable)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    def save(self, endpoint, profile, flush=False):
+        """
+        Adds profile to aggregated stats of endpoint.
+        """
+        with self.lock:
+            if endpoint in self.stats:
+                self.stats[endpoint].add(profile)
+            else:
+                self.stats[endpoint] = pstats.Stats(profile)
+            self.dirty.add(endpoint)
+            self.pending += 1
+            flush = (flush or self.pending >= self.flush_every or
+                     time.time() - self.flushed >= self.flush_interval)
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """
+        Dumps changed aggregated stats to files.
+        """
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            self.pending = 0
+            self.flushed = time.time()
+            try:
+                if dirty and not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                for endpoint in dirty:
+                    self.stats[endpoint].dump_stats(os.path.join(
+                        self.directory, 'profile-%s.prof' % endpoint
+                    ))
+            except (IOError, OSError):
+                log.exception('Cannot save profiles to %s', self.directory)
@@ -32,10 +32,25 @@ del _buildout_path
 
 
 # bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False, warmup=False):
+    from paste.deploy.converters import asbool
     from presence_analyzer import app
+    from presence_analyzer.profiler import SamplingProfiler
+    from presence_analyzer.utils import warm_up, recent_months
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    if app.config.get('DATA_DIR'):
+        recent_months()  # fail at startup on wrong DATA_RECENT_MONTHS
+    rate = app.config.get('PROFILE_RATE', 0)
+    token = app.config.get('PROFILE_TOKEN')
+    if (rate or token) and not isinstance(app.wsgi_app, SamplingProfiler):
+        app.wsgi_app = SamplingProfiler(
+            app.wsgi_app, app.url_map,
+            app.config.get('PROFILE_DIR', abspath('var', 'log')),
+            rate, token,
+        )
+    if asbool(warmup):
+        warm_up()
     return app
 
 
@@ -136,3 +151,24 @@ def update_user_details():
         log.exception('Error saving xml file.')
     except KeyError as e:
         log.exception(e)
+
+
+def partition_data():
+    """
+    Splits presence CSV file into monthly files of DATA_DIR
+    """
+    from presence_analyzer.utils import partition_csv
+    app = make_app()
+    directory = app.config.get('DATA_DIR')
+    if not directory:
+        log.error('DATA_DIR is not configured, nothing to partition.')
+        return
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        months = partition_csv(app.config['DATA_CSV'], directory)
+        log.debug('Partitioned %d months', len(months))
+    except (IOError, OSError):
+        log.exception('Error partitioning csv file.')
+    except KeyError as e:
+        log.exception(e)
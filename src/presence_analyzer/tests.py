@@ -4,10 +4,20 @@ Presence analyzer unit tests.
 """
 import os.path
 import json
+import zlib
+import shutil
+import pstats
 import datetime
+import tempfile
 import unittest
+import threading
+import xml.etree.ElementTree as etree
 
-from presence_analyzer import main, views, utils
+import werkzeug.test
+import werkzeug.wrappers
+
+from presence_analyzer import main, views, utils, helpers, loadtest, \
+    profiler
 
 
 TEST_DATA_CSV = os.path.join(
@@ -46,6 +56,40 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(resp.status_code, 302)
         assert resp.headers['Location'].endswith('/presenceweekday')
 
+    def test_api_formats(self):
+        """
+        Test negotiation of API response formats.
+        """
+        columnar = 'application/vnd.presence-analyzer.columns+json'
+        resp = self.client.get('/api/v1/presence_start_end/10',
+                               headers={'Accept': columnar})
+        self.assertEqual(resp.content_type, columnar)
+        self.assertIn('Accept', resp.headers['Vary'])
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 3)
+        self.assertEqual(data[0][0], 'Mon')
+        self.assertEqual(data[1][1], 34745)
+        resp = self.client.get('/api/v1/users', headers={'Accept': columnar})
+        data = json.loads(resp.data)
+        self.assertEqual(data['user_id'][:2], [10, 11])
+        resp = self.client.get('/api/v1/users', headers={
+            'Accept': 'application/json, text/javascript, */*; q=0.01',
+        })
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertIsInstance(json.loads(resp.data), list)
+        resp = self.client.get('/api/v1/presence_weekday/10',
+                               headers={'Accept': columnar})
+        data = json.loads(resp.data)
+        self.assertEqual(len(data[0]), 7)
+        self.assertNotIn('Weekday', data[0])
+        self.assertNotIn('Presence (s)', data[1])
+        resp = self.client.get('/api/v1/presence_start_end/10',
+                               headers={'Accept': 'application/x-msgpack'})
+        self.assertEqual(resp.content_type, 'application/x-msgpack')
+        data = utils.msgpack.unpackb(resp.data)
+        self.assertEqual(len(data), 7)
+        self.assertEqual(data[1][1], 34745)
+
     def test_presenceweekday(self):
         """
         Test presence weekday page.
@@ -67,6 +111,65 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         resp = self.client.get('/chart/presencestartend')
         self.assertEqual(resp.status_code, 200)
 
+    def test_chart_inline_users(self):
+        """
+        Test users list inlined in chart pages.
+        """
+        for page in ('presenceweekday', 'meantime', 'presencestartend'):
+            resp = self.client.get('/chart/' + page)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('var users = [', resp.data)
+            self.assertIn('Adrian K.', resp.data)
+            self.assertNotIn('/api/v1/users', resp.data)
+        self.assertIs(views.render_chart('meantime'),
+                      views.render_chart('meantime'))
+
+    def test_static(self):
+        """
+        Test fingerprinted static files.
+        """
+        resp = self.client.get('/chart/presenceweekday')
+        hashed = helpers.STATIC_MANIFEST['css/style.css']
+        self.assertNotEqual(hashed, 'css/style.css')
+        self.assertIn('/static/' + hashed, resp.data)
+        resp = self.client.get('/static/' + hashed)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+        resp = self.client.get('/static/' + hashed,
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            zlib.decompress(resp.data, 16 + zlib.MAX_WBITS),
+            helpers.STATIC_ASSETS[hashed]['identity']
+        )
+        resp = self.client.get('/static/css/style.css')
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('immutable', resp.headers.get('Cache-Control', ''))
+
+    def test_health_ready(self):
+        """
+        Test readiness report.
+        """
+        generation = utils.get_data.generation
+        utils.get_data.generation = 0
+        try:
+            resp = self.client.get('/health/ready')
+        finally:
+            utils.get_data.generation = generation
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(json.loads(resp.data), {'ready': False})
+        utils.get_data()
+        resp = self.client.get('/health/ready')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertTrue(data['ready'])
+        self.assertEqual(data['generation'], utils.get_data.generation)
+        self.assertEqual(data['users'], 2)
+        self.assertEqual(data['rows'], 9)
+        self.assertGreaterEqual(data['load_duration'], 0)
+
     def test_api_users(self):
         """
         Test users listing.
@@ -153,6 +256,157 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertIn('Mon', data[0])
         self.assertIn('Sun', data[-1])
 
+    def test_api_presence_percentiles(self):
+        """
+        Test presence percentiles listing.
+        """
+        resp = self.client.get('/api/v1/presence_percentiles/1')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 0)
+        resp = self.client.get('/api/v1/presence_percentiles/10')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 7)
+        self.assertEqual(data[0], ['Mon', 0, 0, 0, 0, 0, 0])
+        self.assertEqual(data[1][0], 'Tue')
+        self.assertAlmostEqual(data[1][1], 34745, delta=60)
+        self.assertAlmostEqual(data[1][3], 64792, delta=60)
+        self.assertAlmostEqual(data[1][5], 30047, delta=60)
+        for row in data:
+            for value in row[1:]:
+                self.assertIsInstance(value, float)
+
+    def test_api_team_percentiles(self):
+        """
+        Test team presence percentiles listing.
+        """
+        resp = self.client.get('/api/v1/team_percentiles')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 7)
+        self.assertIn('Mon', data[0])
+        self.assertIn('Sun', data[-1])
+        self.assertEqual(len(data[0]), 7)
+
+    def test_api_occupancy(self):
+        """
+        Test occupancy listing.
+        """
+        resp = self.client.get('/api/v1/occupancy')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 7)
+        self.assertEqual(data[0][0], 'Mon')
+        self.assertEqual(len(data[0][1]), 96)
+        resp = self.client.get(
+            '/api/v1/occupancy?from=2013-09-10&to=2013-09-10&users=10'
+        )
+        data = json.loads(resp.data)
+        self.assertEqual(data[1][1][38], 1)
+        self.assertEqual(data[1][1][37], 0)
+        self.assertEqual(sum(data[0][1]), 0)
+        resp = self.client.get('/api/v1/occupancy?from=yesterday')
+        self.assertEqual(json.loads(resp.data), [])
+
+    def test_api_present(self):
+        """
+        Test listing of users present at given time.
+        """
+        resp = self.client.get('/api/v1/present?at=2013-09-10T12:00:00')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual([i['user_id'] for i in data], [10, 11])
+        self.assertDictEqual(data[1], {
+            'user_id': 11,
+            'name': 'Adrian K.',
+            'avatar': '/api/images/users/11'
+        })
+        resp = self.client.get('/api/v1/present?at=2013-09-10T16:00:00')
+        data = json.loads(resp.data)
+        self.assertEqual([i['user_id'] for i in data], [10])
+        resp = self.client.get('/api/v1/present?at=2013-09-10')
+        self.assertEqual(json.loads(resp.data), [])
+
+    def test_api_presence_trend(self):
+        """
+        Test weekly presence trend listing.
+        """
+        resp = self.client.get('/api/v1/presence_trend/1')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), [])
+        resp = self.client.get('/api/v1/presence_trend/10')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 52)
+        resp = self.client.get('/api/v1/presence_trend/10?weeks=2')
+        data = json.loads(resp.data)
+        self.assertEqual(data[0], ['2013-09-02', 0, 0])
+        self.assertEqual(data[1][0], '2013-09-09')
+        self.assertAlmostEqual(data[1][1], (30047 + 24465 + 23705) / 3600.0)
+        self.assertAlmostEqual(data[1][2], (34745 + 33592 + 38926) / 3.0)
+        resp = self.client.get('/api/v1/presence_trend/10?weeks=all')
+        self.assertEqual(json.loads(resp.data), [])
+
+    def test_api_compare(self):
+        """
+        Test comparison of user with cohort.
+        """
+        resp = self.client.get('/api/v1/compare/1')
+        self.assertEqual(json.loads(resp.data), [])
+        resp = self.client.get('/api/v1/compare/10?cohort=unknown')
+        self.assertEqual(json.loads(resp.data), [])
+        resp = self.client.get('/api/v1/compare/10')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 7)
+        self.assertEqual(data[0], ['Mon', 0, 24123.0, 0])
+        self.assertEqual(data[1], ['Tue', 30047, 23305.5, 100.0])
+        main.app.config['COHORTS'] = {'team': [10, 12]}
+        utils.get_data.cache[0] = datetime.datetime.min
+        try:
+            resp = self.client.get('/api/v1/compare/10?cohort=team')
+        finally:
+            del main.app.config['COHORTS']
+            utils.get_data.cache[0] = datetime.datetime.min
+        data = json.loads(resp.data)
+        self.assertEqual(data[1], ['Tue', 30047, 30047, 100.0])
+
+    def test_api_cache_keys(self):
+        """
+        Test cached bodies keyed only by parsed query arguments.
+        """
+        for i in range(50):
+            resp = self.client.get('/api/v1/users?x=%d' % i)
+            self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(views.users_view.bodies.cache[1]), 1)
+        self.client.get('/api/v1/occupancy?users=11,10&_=1')
+        self.client.get('/api/v1/occupancy?users=10,11,10&_=2')
+        self.client.get('/api/v1/occupancy?users=abc')
+        keys = views.occupancy_view.bodies.cache[1].keys()
+        self.assertIn(((), (('users', (10, 11)),)), keys)
+        self.assertEqual(
+            len([key for key in keys if key[1] and key[1][0][0] == 'users']),
+            1
+        )
+
+    def test_api_compression(self):
+        """
+        Test compression negotiation of API responses.
+        """
+        headers = {'Accept-Encoding': 'gzip'}
+        resp = self.client.get('/api/v1/occupancy', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        data = json.loads(zlib.decompress(resp.data, 16 + zlib.MAX_WBITS))
+        self.assertEqual(len(data), 7)
+        resp = self.client.get('/api/v1/occupancy')
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(json.loads(resp.data), data)
+        resp = self.client.get('/api/v1/get_avatar/10', headers=headers)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(json.loads(resp.data), '/api/images/users/10')
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -185,6 +439,25 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(data[10][sample_date]['start'],
                          datetime.time(9, 39, 5))
 
+    def test_read_presence_skips_wrong_lines(self):
+        """
+        Test skipping of lines which cannot be parsed.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'presence.csv')
+            with open(path, 'w') as csvfile:
+                csvfile.write(
+                    'user_id,date,start,end\n'
+                    '10,2013-09-10,09:00:00,17:00:00\n'
+                    '10,2013-09-11,broken,17:00:00\n'
+                )
+            data = utils.read_presence(path)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(data.keys(), [10])
+        self.assertEqual(data[10].keys(), [datetime.date(2013, 9, 10)])
+
     def test_get_details(self):
         details = utils.get_details()
         self.assertIsInstance(details, dict)
@@ -194,6 +467,28 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(details[11]['name'], 'Adrian K.')
         self.assertEqual(details[11]['avatar'], '/api/images/users/11')
 
+    def test_get_users(self):
+        """
+        Test users sorted by name.
+        """
+        users = utils.get_users()
+        self.assertEqual([i['user_id'] for i in users], [10, 11, 12])
+        self.assertDictEqual(users[0], {
+            'user_id': 10,
+            'name': 'Adam P.',
+            'avatar': '/api/images/users/10'
+        })
+
+    def test_warm_up(self):
+        """
+        Test loading data in background.
+        """
+        utils.get_data.cache[0] = datetime.datetime.min
+        generation = utils.get_data.generation
+        utils.warm_up().join()
+        self.assertEqual(utils.get_data.generation, generation + 1)
+        self.assertTrue(utils.readiness()['ready'])
+
     def test_group_by_weekday(self):
         """
         Test weekly grouped.
@@ -271,6 +566,561 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         sample_mean = utils.mean([5432.1, 1234.42, 876.23])
         self.assertNotEqual(sample_mean, 7542.75)
 
+    def test_quantile_sketch(self):
+        """
+        Test percentiles estimated by quantile sketch.
+        """
+        sketch = utils.QuantileSketch()
+        self.assertEqual(sketch.percentile(50), 0)
+        self.assertIsInstance(sketch.percentile(50), float)
+        sketch.add(60)
+        self.assertIsInstance(sketch.percentile(0), float)
+        sketch = utils.QuantileSketch()
+        for minute in range(1, 101):
+            sketch.add(minute * 60)
+        self.assertEqual(sketch.total, 100)
+        self.assertAlmostEqual(sketch.percentile(50), 3000, delta=60)
+        self.assertAlmostEqual(sketch.percentile(90), 5400, delta=60)
+        other = utils.QuantileSketch()
+        for minute in range(101, 201):
+            other.add(minute * 60)
+        sketch.merge(other)
+        self.assertEqual(sketch.total, 200)
+        self.assertAlmostEqual(sketch.percentile(50), 6000, delta=60)
+
+    def test_get_sketches(self):
+        """
+        Test sketches grouped by user and weekday.
+        """
+        sketches = utils.get_sketches()
+        self.assertItemsEqual(sketches.keys(), [10, 11])
+        self.assertEqual(sketches[10][0]['start'].total, 0)
+        self.assertEqual(sketches[10][1]['interval'].total, 1)
+        self.assertIs(sketches, utils.get_sketches())
+        team = utils.get_team_sketches()
+        self.assertEqual(
+            team[1]['start'].total,
+            sketches[10][1]['start'].total + sketches[11][1]['start'].total
+        )
+
+    def test_get_occupancy(self):
+        """
+        Test occupancy calculated from difference arrays.
+        """
+        sample_date = datetime.date(2013, 9, 10)
+        occupancy = utils.get_occupancy(sample_date, sample_date, (10,))
+        self.assertEqual(occupancy[1][0], 'Tue')
+        tuesday = occupancy[1][1]
+        # 09:39:05 - 17:59:52
+        self.assertEqual(tuesday[38], 1)
+        self.assertEqual(tuesday[71], 1)
+        self.assertEqual(tuesday[72], 0)
+        self.assertEqual(sum(tuesday), 34)
+        self.assertIs(
+            occupancy,
+            utils.get_occupancy(sample_date, sample_date, (10,))
+        )
+
+    def test_data_cache_size(self):
+        """
+        Test eviction of least recently used results.
+        """
+        calls = []
+
+        @utils.data_cache
+        def square(number):
+            calls.append(number)
+            return number * number
+
+        main.app.config['DATA_CACHE_SIZE'] = 2
+        try:
+            self.assertEqual(square(2), 4)
+            self.assertEqual(square(3), 9)
+            self.assertEqual(square(2), 4)
+            self.assertEqual(square(4), 16)
+            self.assertEqual(square.cache[1].keys(), [(2,), (4,)])
+            self.assertEqual(square(3), 9)
+        finally:
+            del main.app.config['DATA_CACHE_SIZE']
+        self.assertEqual(calls, [2, 3, 4, 3])
+
+    def test_data_cache_concurrency(self):
+        """
+        Test calculation of different arguments outside of cache lock.
+        """
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        @utils.data_cache
+        def slow(number):
+            calls.append(number)
+            if number == 1:
+                started.set()
+                release.wait(5)
+            return number
+
+        threads = [threading.Thread(target=slow, args=(1,)) for _ in range(2)]
+        threads[0].start()
+        started.wait(5)
+        threads[1].start()
+        self.assertEqual(slow(2), 2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(calls), [1, 2])
+
+    def test_columns(self):
+        """
+        Test columnar layout of results.
+        """
+        self.assertEqual(utils.columns([]), [])
+        self.assertEqual(utils.columns('path'), 'path')
+        self.assertEqual(utils.columns([('Mon', 1, 2), ('Tue', 3, 4)]),
+                         [['Mon', 'Tue'], [1, 3], [2, 4]])
+        self.assertEqual(
+            utils.columns([('Weekday', 'Presence (s)'), ('Mon', 1)]),
+            [['Mon'], [1]]
+        )
+        self.assertEqual(utils.columns([('Mon', 'Tue'), ('Wed', 'Thu')]),
+                         [['Mon', 'Wed'], ['Tue', 'Thu']])
+        self.assertEqual(
+            utils.columns([{'user_id': 1, 'name': 'A'},
+                           {'user_id': 2, 'name': 'B'}]),
+            {'user_id': [1, 2], 'name': ['A', 'B']}
+        )
+
+    def test_weekly_trends(self):
+        """
+        Test incremental updates of weekly trends.
+        """
+        monday = datetime.date(2013, 9, 9)
+        tuesday = datetime.date(2013, 9, 10)
+        nine = datetime.time(9, 0, 0)
+        sources = {
+            'a.csv': {1: {monday: {'start': nine,
+                                   'end': datetime.time(17, 0)}}},
+        }
+        loaded = []
+
+        def load(path):
+            loaded.append(path)
+            return sources[path]
+        trends = utils.WeeklyTrends()
+        trends.sync([('a.csv', 1)], load)
+        self.assertEqual(trends.series(1, 1), [('2013-09-09', 8.0, 32400)])
+        self.assertEqual(trends.series(2, 1), [])
+        sources['a.csv'] = {1: {monday: {'start': nine,
+                                         'end': datetime.time(13, 0)}}}
+        sources['b.csv'] = {
+            1: {tuesday: {'start': datetime.time(10, 0), 'end': nine}},
+            2: {tuesday - datetime.timedelta(weeks=1): {
+                'start': nine, 'end': datetime.time(10, 0),
+            }},
+        }
+        del loaded[:]
+        trends.sync([('a.csv', 1), ('b.csv', 1)], load)
+        self.assertEqual(loaded, ['b.csv'])
+        self.assertEqual(trends.series(1, 1), [('2013-09-09', 7.0, 34200)])
+        trends.sync([('a.csv', 2), ('b.csv', 1)], load)
+        self.assertEqual(trends.series(1, 2), [
+            ('2013-09-02', 0, 0), ('2013-09-09', 3.0, 34200),
+        ])
+        self.assertEqual(trends.series(2, 2)[0], ('2013-09-02', 1.0, 32400))
+        del sources['b.csv'][1]
+        trends.sync([('b.csv', 2)], load)
+        self.assertEqual(trends.series(1, 1), [])
+        self.assertItemsEqual(trends.buckets.keys(), [2])
+        self.assertItemsEqual(trends.sources.keys(), ['b.csv'])
+        self.assertEqual(trends.last_week, datetime.date(2013, 9, 2))
+
+    def test_get_trends_changed_file(self):
+        """
+        Test weekly trends of file changed after presence data was loaded.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'presence.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write('10,2013-09-09,09:00:00,17:00:00\n')
+        os.utime(path, (1000, 1000))
+        main.app.config['DATA_CSV'] = path
+        utils.get_data.cache[0] = datetime.datetime.min
+        self.addCleanup(utils.get_data.cache.__setitem__, 0,
+                        datetime.datetime.min)
+        self.assertEqual(len(utils.get_data()[10]), 1)
+        with open(path, 'a') as csvfile:
+            csvfile.write('10,2013-09-10,09:00:00,17:00:00\n')
+        os.utime(path, (2000, 2000))
+        self.assertEqual(utils.get_trends().series(10, 1),
+                         [('2013-09-09', 16.0, 32400)])
+
+    def test_get_trends_without_details(self):
+        """
+        Test weekly trends when users XML file is missing.
+        """
+        main.app.config['DATA_XML'] = os.path.join(tempfile.gettempdir(),
+                                                   'missing-users.xml')
+        utils.get_data.cache[0] = datetime.datetime.min
+        self.addCleanup(utils.get_data.cache.__setitem__, 0,
+                        datetime.datetime.min)
+        self.assertEqual(utils.get_trends().buckets, {})
+
+    def test_get_cohorts(self):
+        """
+        Test aggregates of global cohort.
+        """
+        means = utils.get_weekday_means()
+        self.assertItemsEqual(means[10].keys(), [1, 2, 3])
+        self.assertEqual(means[10][1], 30047)
+        cohort = utils.get_cohorts()['all']
+        self.assertItemsEqual(cohort['members'], [10, 11])
+        self.assertEqual(cohort['sorted'][1], [16564.0, 30047.0])
+        self.assertEqual(cohort['means'][1], 23305.5)
+        self.assertEqual(cohort['means'][5], 0)
+
+    def test_percentile_rank(self):
+        """
+        Test percentile rank in sorted values.
+        """
+        self.assertEqual(utils.percentile_rank([], 5), 0)
+        self.assertEqual(utils.percentile_rank([1, 2, 3, 4], 2), 50.0)
+        self.assertEqual(utils.percentile_rank([1, 2, 3, 4], 0), 0)
+        self.assertEqual(utils.percentile_rank([1, 2, 3, 4], 9), 100.0)
+
+    def test_gzip_compress(self):
+        """
+        Test gzip compression of response bodies.
+        """
+        body = json.dumps(range(1000))
+        compressed = utils.gzip_compress(body)
+        self.assertLess(len(compressed), len(body))
+        self.assertEqual(
+            zlib.decompress(compressed, 16 + zlib.MAX_WBITS), body
+        )
+
+    def test_interval_tree(self):
+        """
+        Test interval tree queries.
+        """
+        tree = utils.IntervalTree([
+            (0, 10, 'a'), (5, 15, 'b'), (20, 30, 'c'), (12, 25, 'd'),
+        ])
+        self.assertItemsEqual(tree.query(7), ['a', 'b'])
+        self.assertItemsEqual(tree.query(10), ['a', 'b'])
+        self.assertItemsEqual(tree.query(22), ['c', 'd'])
+        self.assertItemsEqual(tree.query(16), ['d'])
+        self.assertItemsEqual(tree.query(31), [])
+        self.assertItemsEqual(tree.query(-1), [])
+        tree = utils.IntervalTree([(10, 5, 'x'), (0, 10, 'a')])
+        self.assertItemsEqual(tree.query(7), ['a'])
+        self.assertItemsEqual(utils.IntervalTree([(10, 5, 'x')]).query(7), [])
+
+    def test_present_at_reversed(self):
+        """
+        Test users present at given datetime with reversed presence.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'presence.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write('10,2013-09-10,17:00:00,09:00:00\n'
+                          '11,2013-09-10,09:00:00,17:00:00\n')
+        main.app.config['DATA_CSV'] = path
+        utils.get_data.cache[0] = datetime.datetime.min
+        self.addCleanup(utils.get_data.cache.__setitem__, 0,
+                        datetime.datetime.min)
+        moment = datetime.datetime(2013, 9, 10, 12, 0)
+        self.assertEqual(utils.present_at(moment), [11])
+
+    def test_present_at(self):
+        """
+        Test users present at given datetime.
+        """
+        moment = datetime.datetime(2013, 9, 10, 9, 30)
+        self.assertEqual(utils.present_at(moment), [11])
+        moment = datetime.datetime(2013, 9, 10, 13, 55, 54)
+        self.assertEqual(utils.present_at(moment), [10, 11])
+        moment = datetime.datetime(2013, 9, 1, 12, 0)
+        self.assertEqual(utils.present_at(moment), [])
+
+
+class PresenceAnalyzerPartitionsTestCase(unittest.TestCase):
+    """
+    Monthly partitions of presence data tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        source = os.path.join(self.directory, 'presence.csv')
+        with open(source, 'w') as csvfile:
+            csvfile.write(
+                'user_id,date,start,end\n'
+                '10,2013-07-02,09:00:00,17:00:00\n'
+                '10,2013-08-06,09:00:00,17:00:00\n'
+                '10,2013-09-10,09:00:00,17:00:00\n'
+                '11,2013-09-10,08:00:00,12:00:00\n'
+                '99,2013-09-10,08:00:00,12:00:00\n'
+            )
+        self.months = utils.partition_csv(source, self.directory)
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_XML': TEST_DATA_XML,
+            'DATA_DIR': self.directory,
+            'DATA_RECENT_MONTHS': 2,
+        })
+        utils.get_data.cache[0] = datetime.datetime.min
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        del main.app.config['DATA_DIR']
+        del main.app.config['DATA_RECENT_MONTHS']
+        utils.get_data.cache[0] = datetime.datetime.min
+        shutil.rmtree(self.directory)
+
+    def test_partition_csv(self):
+        """
+        Test splitting of presence CSV file by months.
+        """
+        self.assertEqual(self.months, ['2013-07', '2013-08', '2013-09'])
+        self.assertEqual(
+            [month for month, _ in utils.data_partitions()],
+            [(2013, 7), (2013, 8), (2013, 9)]
+        )
+        self.assertFalse([name for name in os.listdir(self.directory)
+                          if name.endswith('.tmp')])
+        with open(os.path.join(self.directory, '2013-09.csv')) as csvfile:
+            self.assertEqual(len(csvfile.readlines()), 3)
+
+    def test_get_data(self):
+        """
+        Test loading of recent partitions only.
+        """
+        data = utils.get_data()
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertItemsEqual(data[10].keys(), [
+            datetime.date(2013, 8, 6), datetime.date(2013, 9, 10),
+        ])
+
+    def test_get_data_range(self):
+        """
+        Test loading of partitions touched by dates range.
+        """
+        data = utils.get_data_range(datetime.date(2013, 7, 1),
+                                    datetime.date(2013, 7, 31))
+        self.assertItemsEqual(data.keys(), [10])
+        self.assertItemsEqual(data[10].keys(), [datetime.date(2013, 7, 2)])
+        data = utils.get_data_range(datetime.date(2013, 7, 1),
+                                    datetime.date(2013, 9, 30))
+        self.assertEqual(len(data[10]), 3)
+        self.assertEqual(len(utils.get_data()[10]), 2)
+        self.assertIs(utils.get_data_range(), utils.get_data())
+        self.assertIs(utils.get_data_range(datetime.date(2013, 8, 1)),
+                      utils.get_data())
+        self.assertEqual(
+            utils.present_at(datetime.datetime(2013, 7, 2, 12, 0)), [10]
+        )
+
+    def test_get_trends(self):
+        """
+        Test weekly trends of all partitions.
+        """
+        trends = utils.get_trends()
+        self.assertItemsEqual(trends.sources.keys(), [
+            os.path.join(self.directory, '%s.csv' % month)
+            for month in self.months
+        ])
+        self.assertEqual(trends.weeks[10][0], datetime.date(2013, 7, 1))
+        self.assertEqual(trends.series(11, 1)[0][1], 4.0)
+
+    def test_recent_months(self):
+        """
+        Test rejecting less than one recent month.
+        """
+        main.app.config['DATA_RECENT_MONTHS'] = 0
+        with self.assertRaises(ValueError):
+            utils.get_data()
+
+    def test_partition_cache(self):
+        """
+        Test eviction of least recently used partitions.
+        """
+        cache = utils.PartitionCache()
+        paths = [path for _, path in utils.data_partitions()]
+        cache.get(paths[0], 2)
+        cache.get(paths[2], 2)
+        self.assertEqual(cache.partitions.keys(), [paths[2]])
+        self.assertEqual(cache.rows, 3)
+        cache.get(paths[0], 4)
+        cache.get(paths[1], 4)
+        self.assertEqual(cache.partitions.keys(), [paths[0], paths[1]])
+        cache.get(paths[0], 4)
+        cache.get(paths[2], 4)
+        self.assertEqual(cache.partitions.keys(), [paths[0], paths[2]])
+        self.assertEqual(cache.rows, 4)
+
+
+class PresenceAnalyzerLoadTestTestCase(unittest.TestCase):
+    """
+    Load test tool tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.directory)
+
+    def test_generate_data(self):
+        """
+        Test synthetic data generation.
+        """
+        csv_path, xml_path = loadtest.generate_data(self.directory, 3, 7)
+        with open(csv_path) as csvfile:
+            rows = csvfile.read().splitlines()
+        self.assertEqual(rows[0], 'user_id,date,start,end')
+        self.assertLessEqual(len(rows) - 1, 3 * 5)
+        user_id, date, start, end = rows[1].split(',')
+        self.assertLess(start, end)
+        tree = etree.parse(xml_path)
+        self.assertEqual(len(tree.getroot().find('users')), 3)
+
+    def test_expiring(self):
+        """
+        Test expiring of presence data by server middleware.
+        """
+        app = loadtest.expiring(main.app.wsgi_app)
+        client = werkzeug.test.Client(app, werkzeug.wrappers.BaseResponse)
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV,
+                                'DATA_XML': TEST_DATA_XML})
+        utils.get_data()
+        generation = utils.get_data.generation
+        resp = client.get(loadtest.EXPIRE_PATH)
+        self.assertEqual(resp.data, 'expired')
+        utils.get_data()
+        self.assertEqual(utils.get_data.generation, generation + 1)
+        resp = client.get('/chart/meantime')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(loadtest.STATIC_URL.findall(resp.data))
+
+    def test_recorder_merge(self):
+        """
+        Test merging latencies of client processes.
+        """
+        recorder = loadtest.Recorder()
+        recorder.record('chart', 0.1, True)
+        recorder.merge({'chart': [0.2], 'static': [0.3]}, {'static': 1})
+        self.assertEqual(recorder.latencies,
+                         {'chart': [0.1, 0.2], 'static': [0.3]})
+        self.assertEqual(recorder.errors, {'static': 1})
+
+    def test_percentile(self):
+        """
+        Test nearest-rank percentile of latencies.
+        """
+        self.assertEqual(loadtest.percentile([], 50), 0)
+        items = range(101)
+        self.assertEqual(loadtest.percentile(items, 50), 50)
+        self.assertEqual(loadtest.percentile(items, 99), 99)
+        self.assertEqual(loadtest.percentile(items, 100), 100)
+
+
+class PresenceAnalyzerProfilerTestCase(unittest.TestCase):
+    """
+    Profiler middleware tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.directory)
+
+    def get(self, middleware, path, **kwargs):
+        """
+        Calls middleware wrapped around application.
+        """
+        wsgi_app = main.app.wsgi_app
+        main.app.wsgi_app = middleware(wsgi_app)
+        try:
+            return main.app.test_client().get(path, **kwargs)
+        finally:
+            main.app.wsgi_app = wsgi_app
+
+    def test_sampled_request(self):
+        """
+        Test aggregated profile of sampled requests.
+        """
+        def middleware(app):
+            self.profiler = profiler.SamplingProfiler(
+                app, main.app.url_map, self.directory, rate=1, flush_every=3
+            )
+            return self.profiler
+        resp = self.get(middleware, '/api/v1/mean_time_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(json.loads(resp.data)), 7)
+        self.get(middleware, '/api/v1/mean_time_weekday/11')
+        self.assertEqual(os.listdir(self.directory), [])
+        self.profiler.flush()
+        self.assertEqual(os.listdir(self.directory),
+                         ['profile-mean_time_weekday_view.prof'])
+        stats = pstats.Stats(os.path.join(
+            self.directory, 'profile-mean_time_weekday_view.prof'
+        ))
+        self.assertGreater(stats.total_calls, 0)
+
+    def test_unmatched_requests(self):
+        """
+        Test single aggregate of requests not matching any rule.
+        """
+        def middleware(app):
+            self.profiler = profiler.SamplingProfiler(
+                app, main.app.url_map, self.directory, rate=1
+            )
+            return self.profiler
+        for i in range(5):
+            resp = self.get(middleware, '/scan/%d/admin.php' % i)
+            self.assertEqual(resp.status_code, 404)
+        self.assertEqual(self.profiler.stats.keys(), [profiler.UNMATCHED])
+        self.profiler.flush()
+        self.assertEqual(os.listdir(self.directory),
+                         ['profile-unmatched.prof'])
+
+    def test_token_request(self):
+        """
+        Test profiling of requests with token flushed immediately.
+        """
+        def middleware(app):
+            return profiler.SamplingProfiler(app, main.app.url_map,
+                                             self.directory, token='secret')
+        self.get(middleware, '/api/v1/users')
+        self.get(middleware, '/api/v1/users', headers={'X-Profile': 'bad'})
+        self.assertEqual(os.listdir(self.directory), [])
+        resp = self.get(middleware, '/api/v1/users',
+                        headers={'X-Profile': 'secret'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(os.listdir(self.directory),
+                         ['profile-users_view.prof'])
+
 
 def suite():
     """
@@ -279,6 +1129,9 @@ def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerPartitionsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerLoadTestTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerProfilerTestCase))
     return suite
 
 
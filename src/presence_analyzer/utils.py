@@ -3,56 +3,236 @@
 Helper functions used in views.
 """
 
+import calendar
+import os
+import re
 import csv
+import bisect
+import locale
 import threading
+import zlib
 import xml.etree.ElementTree as etree
 from json import dumps
 from functools import wraps
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
-from flask import Response
+import msgpack
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # pylint: disable-msg=C0103
 
 from presence_analyzer.main import app
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
+PERCENTILES = (50, 90)
+SLOT = 900  # seconds in occupancy time slot
+COMPRESS_MIN_SIZE = 1024  # smaller responses are sent uncompressed
+DATA_CACHE_SIZE = 1024  # results kept by each `data_cache` function
+RECENT_MONTHS = 12  # monthly partitions kept in `get_data`
+CACHE_ROWS = 500000  # rows of older partitions paged in by `get_data_range`
+PARTITION_NAME = re.compile(r'^(\d{4})-(\d{2})\.csv$')
+PRESENCE_DATE = re.compile(r'\d{4}-\d{2}-\d{2}$')
+TREND_WEEKS = 52
+COHORT = 'all'  # cohort of all users
+
 
-def jsonify(function):
+def jsonify(function=None, query=None):
     """
     Creates a response with the JSON representation of wrapped function result.
+
+    Result format is negotiated with `Accept` header (plain JSON by
+    default, see FORMATS) and compression with `Accept-Encoding` header.
+    Encoded bodies are kept until presence data reload.
+
+    Optional `query` function parses request arguments into keyword
+    arguments of wrapped function and raises ValueError for wrong ones,
+    which are answered with empty list. Other request arguments are not
+    part of cache key.
     """
+    if function is None:
+        return lambda function: jsonify(function, query)
+
+    @data_cache
+    def bodies(args, kwargs):
+        """
+        Function result and its bodies keyed by mimetype and encoding.
+        """
+        return {None: function(*args, **dict(kwargs))}
+
     @wraps(function)
     def inner(*args, **kwargs):
-        return Response(dumps(function(*args, **kwargs)),
-                        mimetype='application/json')
+        try:
+            if query is not None:
+                kwargs.update(query(request.args))
+        except ValueError:
+            log.debug('Wrong query arguments: %s', request.args)
+            encoded = {None: []}
+        else:
+            encoded = bodies(args, tuple(sorted(kwargs.items())))
+        mimetype = request.accept_mimetypes.best_match(
+            [i for i, _ in FORMATS], 'application/json'
+        )
+        if (mimetype, 'identity') not in encoded:
+            encoded[mimetype, 'identity'] = dict(FORMATS)[mimetype](
+                encoded[None]
+            )
+        encoding = 'identity'
+        min_size = app.config.get('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE)
+        if len(encoded[mimetype, 'identity']) >= min_size:
+            encoding = request.accept_encodings.best_match(
+                COMPRESSORS.keys(), 'identity'
+            )
+        if (mimetype, encoding) not in encoded:
+            encoded[mimetype, encoding] = COMPRESSORS[encoding](
+                encoded[mimetype, 'identity']
+            )
+        response = Response(encoded[mimetype, encoding], mimetype=mimetype)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept')
+        response.vary.add('Accept-Encoding')
+        return response
+    inner.bodies = bodies
     return inner
 
 
+def columns(result):
+    """
+    Transposes list of rows into list of columns and list of dicts into
+    dict of lists. Other results are returned unchanged.
+
+    Leading header row of labels, like ('Weekday', 'Presence (s)') of
+    presence weekday chart data, is dropped, so each column holds only
+    values of the same type.
+    """
+    if not isinstance(result, list) or not result:
+        return result
+    if all(isinstance(row, dict) for row in result):
+        return {key: [row.get(key) for row in result] for key in result[0]}
+    if all(isinstance(row, (list, tuple)) for row in result):
+        if len(result) > 1 and is_header(result[0]) and \
+                not is_header(result[1]):
+            result = result[1:]
+        return [list(column) for column in zip(*result)]
+    return result
+
+
+def is_header(row):
+    """
+    Checks whether row contains only labels.
+    """
+    return all(isinstance(i, basestring) for i in row)
+
+
+FORMATS = [
+    ('application/json', dumps),
+    ('application/vnd.presence-analyzer.columns+json',
+     lambda result: dumps(columns(result))),
+    ('application/x-msgpack', msgpack.packb),
+]
+
+
+def gzip_compress(body):
+    """
+    Compresses body into gzip format.
+    """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+COMPRESSORS = {'gzip': gzip_compress}
+if brotli is not None:
+    COMPRESSORS['br'] = brotli.compress
+
+
 def cache(sec):
     """
     Save to cash function result for given period of time.
+
+    Every recalculation bumps `generation` attribute of decorated function
+    and saves its time in seconds as `duration` attribute.
     """
     def decorator(fun):
         cache_lock = threading.Lock()
         fun.cache = [datetime.now(), {}]
 
+        @wraps(fun)
         def wrapper(*args, **kwargs):
             with cache_lock:
                 now = datetime.now()
                 if now > fun.cache[0]:
                     fun.cache[0] = now + timedelta(seconds=sec)
                     fun.cache[1] = fun(*args, **kwargs)
+                    wrapper.generation += 1
+                    wrapper.duration = (
+                        datetime.now() - now
+                    ).total_seconds()
                 return fun.cache[1]
+        wrapper.cache = fun.cache
+        wrapper.generation = 0
+        wrapper.duration = None
         return wrapper
     return decorator
 
 
+def data_cache(fun):
+    """
+    Save function results for given arguments until presence data reload.
+
+    At most DATA_CACHE_SIZE least recently used results are kept.
+    Results are calculated outside of cache lock, concurrent calls with
+    the same arguments wait for single calculation.
+    """
+    cache_lock = threading.Lock()
+    fun.cache = [None, OrderedDict(), {}]
+
+    @wraps(fun)
+    def wrapper(*args):
+        get_data()
+        with cache_lock:
+            if fun.cache[0] != get_data.generation:
+                fun.cache[0] = get_data.generation
+                fun.cache[1] = OrderedDict()
+                fun.cache[2] = {}
+            results, locks = fun.cache[1], fun.cache[2]
+            if args in results:
+                results[args] = results.pop(args)
+                return results[args]
+            key_lock = locks.setdefault(args, threading.Lock())
+
+        with key_lock:
+            with cache_lock:
+                if args in results:
+                    return results[args]
+            try:
+                result = fun(*args)
+                with cache_lock:
+                    results[args] = result
+                    size = app.config.get('DATA_CACHE_SIZE', DATA_CACHE_SIZE)
+                    while len(results) > size:
+                        results.popitem(last=False)
+            finally:
+                with cache_lock:
+                    locks.pop(args, None)
+            return result
+    wrapper.cache = fun.cache
+    return wrapper
+
+
 @cache(600)
 def get_data():
     """
     Extracts presence data from CSV file and groups it by user_id.
 
+    When DATA_DIR is configured only DATA_RECENT_MONTHS latest monthly
+    partitions are loaded, older ones are paged in by `get_data_range`.
+
     It creates structure like this:
     data = {
         'user_id': {
@@ -67,11 +247,21 @@ def get_data():
         }
     }
     """
-    usage_id = get_details()
+    if app.config.get('DATA_DIR'):
+        return known_users(merge_presence(
+            read_presence(path)
+            for _, path in data_partitions()[-recent_months():]
+        ))
+    return known_users(read_presence(app.config['DATA_CSV']))
+
+
+def read_presence(path):
+    """
+    Reads presence CSV file and groups it by user_id like `get_data`.
+    """
     data = {}
-    err = []
 
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
+    with open(path, 'r') as csvfile:
         presence_reader = csv.reader(csvfile, delimiter=',')
         for i, row in enumerate(presence_reader):
             if len(row) != 4:
@@ -85,21 +275,158 @@ def get_data():
                 end = datetime.strptime(row[3], '%H:%M:%S').time()
             except (ValueError, TypeError):
                 log.debug('Problem with line %d: ', i, exc_info=True)
+                continue
 
-            if user_id in usage_id:
-                data.setdefault(user_id, {})[date] = {
-                    'start': start,
-                    'end': end,
-                }
-            else:
-                err.append(user_id)
+            data.setdefault(user_id, {})[date] = {
+                'start': start,
+                'end': end,
+            }
 
-        for e in set(err):
-            log.debug("User %d presence data exist but details doesn't.", e)
+    return data
 
+
+def known_users(data):
+    """
+    Removes presence data of users without details.
+    """
+    usage_id = get_details()
+    for user_id in set(data) - set(usage_id):
+        log.debug("User %d presence data exist but details doesn't.", user_id)
+        del data[user_id]
     return data
 
 
+class PartitionCache(object):
+    """
+    Least recently used monthly presence partitions limited by rows count.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.partitions = OrderedDict()
+        self.rows = 0
+
+    def get(self, path, budget):
+        """
+        Returns presence data of partition file, reads it again when changed.
+        """
+        mtime = os.path.getmtime(path)
+        with self.lock:
+            entry = self.partitions.pop(path, None)
+            if entry is not None and entry[0] != mtime:
+                self.rows -= entry[1]
+                entry = None
+            if entry is None:
+                data = read_presence(path)
+                entry = (mtime, sum(len(i) for i in data.values()), data)
+                self.rows += entry[1]
+            self.partitions[path] = entry
+            while self.rows > budget and len(self.partitions) > 1:
+                _, evicted = self.partitions.popitem(last=False)
+                self.rows -= evicted[1]
+            return entry[2]
+
+
+PARTITIONS = PartitionCache()
+
+
+def data_partitions():
+    """
+    Returns sorted ((year, month), path) pairs of DATA_DIR monthly files.
+    """
+    directory = app.config['DATA_DIR']
+    result = []
+    for name in os.listdir(directory):
+        match = PARTITION_NAME.match(name)
+        if match:
+            month = (int(match.group(1)), int(match.group(2)))
+            result.append((month, os.path.join(directory, name)))
+    return sorted(result)
+
+
+def recent_months():
+    """
+    Returns number of recent monthly partitions kept in `get_data`.
+    """
+    recent = app.config.get('DATA_RECENT_MONTHS', RECENT_MONTHS)
+    if recent < 1:
+        raise ValueError('DATA_RECENT_MONTHS must be at least 1: %s' % recent)
+    return recent
+
+
+def merge_presence(parts):
+    """
+    Merges presence data grouped by user_id without modifying the parts.
+    """
+    data = {}
+    for part in parts:
+        for user_id, items in part.items():
+            data.setdefault(user_id, {}).update(items)
+    return data
+
+
+def get_data_range(start=None, end=None):
+    """
+    Returns presence data of months touched by given dates range.
+
+    Without DATA_DIR or range it is the same as `get_data`. Otherwise
+    recent months come from `get_data` and older ones are paged in from
+    partition files on demand, so DATA_CACHE_ROWS limits only the older
+    months kept in memory next to the recent ones.
+    """
+    if not app.config.get('DATA_DIR') or start is None and end is None:
+        return get_data()
+
+    def touched(month):
+        """
+        Checks whether month overlaps dates range.
+        """
+        return ((start is None or month >= (start.year, start.month)) and
+                (end is None or month <= (end.year, end.month)))
+
+    partitions = data_partitions()
+    recent = recent_months()
+    older = [path for month, path in partitions[:-recent] if touched(month)]
+    if not older:
+        return get_data()
+
+    budget = app.config.get('DATA_CACHE_ROWS', CACHE_ROWS)
+    parts = [PARTITIONS.get(path, budget) for path in older]
+    if any(touched(month) for month, _ in partitions[-recent:]):
+        parts.append(get_data())
+    return known_users(merge_presence(parts))
+
+
+def partition_csv(source, directory):
+    """
+    Splits presence CSV file into monthly YYYY-MM.csv files.
+
+    Rows are streamed to open file of their month, so memory use does
+    not grow with source size. Files are replaced when all are written.
+    """
+    writers = {}
+    files = []
+    try:
+        with open(source, 'r') as csvfile:
+            for row in csv.reader(csvfile, delimiter=','):
+                if len(row) != 4 or not PRESENCE_DATE.match(row[1]):
+                    continue
+                month = row[1][:7]
+                if month not in writers:
+                    path = os.path.join(directory, month + '.csv')
+                    files.append(open(path + '.tmp', 'wb'))
+                    writers[month] = csv.writer(files[-1])
+                writers[month].writerow(row)
+    finally:
+        for monthfile in files:
+            monthfile.close()
+
+    for month in writers:
+        path = os.path.join(directory, month + '.csv')
+        os.rename(path + '.tmp', path)
+    return sorted(writers)
+
+
 def get_details():
     """
     Parse XML file and groups it by user_id.
@@ -128,6 +455,62 @@ def get_details():
     return details
 
 
+@data_cache
+def get_users():
+    """
+    Returns users details sorted by name with polish collation.
+    """
+    result = [{'user_id': i, 'name': val['name'], 'avatar': val['avatar']}
+              for i, val in get_details().items()]
+
+    loc = locale.getlocale()
+    try:
+        locale.setlocale(locale.LC_ALL, 'pl_PL.UTF-8')
+    except locale.Error:
+        log.debug('Polish locale is not available')
+        result.sort(key=lambda k: k['name'])
+    else:
+        result.sort(key=lambda k: locale.strxfrm(k['name']))
+        locale.setlocale(locale.LC_ALL, loc)
+
+    return result
+
+
+def warm_up():
+    """
+    Loads presence data and users list in background thread.
+    """
+    def load():
+        """
+        Loads data logging failures.
+        """
+        try:
+            get_users()
+        except Exception:  # pylint: disable-msg=W0703
+            log.exception('Warm up failed')
+
+    thread = threading.Thread(target=load, name='warm-up')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def readiness():
+    """
+    Returns state of loaded presence data without loading it.
+    """
+    if not get_data.generation:
+        return {'ready': False}
+    data = get_data.cache[1]
+    return {
+        'ready': True,
+        'generation': get_data.generation,
+        'load_duration': get_data.duration,
+        'users': len(data),
+        'rows': sum(len(items) for items in data.values()),
+    }
+
+
 def group_by_weekday(items):
     """
     Groups presence entries by weekday.
@@ -174,3 +557,439 @@ def mean(items):
     Calculates arithmetic mean. Returns zero for empty lists.
     """
     return float(sum(items)) / len(items) if len(items) > 0 else 0
+
+
+class QuantileSketch(object):
+    """
+    Mergeable fixed-bucket histogram approximating quantiles of seconds.
+    """
+
+    def __init__(self, width=60):
+        self.width = width
+        self.counts = {}
+        self.total = 0
+
+    def add(self, value):
+        """
+        Counts value in its bucket.
+        """
+        bucket = int(value) // self.width
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+
+    def merge(self, other):
+        """
+        Adds counts of other sketch with the same bucket width.
+        """
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.total += other.total
+        return self
+
+    def percentile(self, percent):
+        """
+        Estimates given percentile as float. Returns zero for empty
+        sketches.
+        """
+        if not self.total:
+            return 0.0
+        rank = self.total * percent / 100.0
+        seen = 0
+        for bucket in sorted(self.counts):
+            count = self.counts[bucket]
+            if seen + count >= rank:
+                offset = max(rank - seen - 0.5, 0.0) / count
+                return (bucket + offset) * self.width
+            seen += count
+        return float((bucket + 1) * self.width)
+
+
+def weekday_sketches():
+    """
+    Creates empty start, end and interval sketches for each weekday.
+    """
+    return {
+        i: {
+            'start': QuantileSketch(),
+            'end': QuantileSketch(),
+            'interval': QuantileSketch(),
+        }
+        for i in range(7)
+    }
+
+
+@data_cache
+def get_sketches():
+    """
+    Builds quantile sketches of presence grouped by user_id and weekday.
+
+    It creates structure like this:
+    sketches = {
+        'user_id': {
+            0: {
+                'start': QuantileSketch(),
+                'end': QuantileSketch(),
+                'interval': QuantileSketch(),
+            },
+        }
+    }
+    """
+    sketches = {}
+    for user_id, items in get_data().items():
+        weekdays = sketches[user_id] = weekday_sketches()
+        for date in items:
+            start = items[date]['start']
+            end = items[date]['end']
+            weekday = weekdays[date.weekday()]
+            weekday['start'].add(seconds_since_midnight(start))
+            weekday['end'].add(seconds_since_midnight(end))
+            weekday['interval'].add(interval(start, end))
+    return sketches
+
+
+@data_cache
+def get_team_sketches():
+    """
+    Merges sketches of all users into team-wide sketches by weekday.
+    """
+    team = weekday_sketches()
+    for weekdays in get_sketches().values():
+        for weekday, sketches in weekdays.items():
+            for key, sketch in sketches.items():
+                team[weekday][key].merge(sketch)
+    return team
+
+
+def percentiles_by_weekday(weekdays):
+    """
+    Returns median and 90th percentile of start, end and interval by weekday.
+    """
+    return [
+        (calendar.day_abbr[weekday],) + tuple(
+            sketches[key].percentile(percent)
+            for key in ('start', 'end', 'interval')
+            for percent in PERCENTILES
+        )
+        for weekday, sketches in sorted(weekdays.items())
+    ]
+
+
+@data_cache
+def get_occupancy(start=None, end=None, users=None):
+    """
+    Calculates mean number of present users in each time slot by weekday.
+
+    Every presence adds one at its first slot and subtracts one after
+    its last slot of weekday difference array, so prefix sums give
+    occupancy without walking over each slot of each presence.
+    Optional filters limit dates to given range and users to given ids.
+    """
+    slots = 24 * 3600 // SLOT
+    diffs = {i: [0] * (slots + 1) for i in range(7)}
+    dates = {i: set() for i in range(7)}
+    data = get_data_range(start, end)
+    for user_id in data if users is None else users:
+        items = data.get(user_id, {})
+        for date in items:
+            if start and date < start or end and date > end:
+                continue
+            first = seconds_since_midnight(items[date]['start']) // SLOT
+            last = seconds_since_midnight(items[date]['end']) // SLOT
+            if last < first:
+                continue
+            diffs[date.weekday()][first] += 1
+            diffs[date.weekday()][last + 1] -= 1
+            dates[date.weekday()].add(date)
+
+    result = []
+    for weekday in range(7):
+        days = len(dates[weekday])
+        present = 0
+        row = []
+        for diff in diffs[weekday][:slots]:
+            present += diff
+            row.append(float(present) / days if days else 0)
+        result.append((calendar.day_abbr[weekday], row))
+    return result
+
+
+class IntervalTree(object):
+    """
+    Static centered interval tree of (start, end, value) tuples.
+    """
+
+    def __init__(self, intervals):
+        # reversed intervals cover no point and would never fit a node
+        intervals = [i for i in intervals if i[0] <= i[1]]
+        points = sorted(point for item in intervals for point in item[:2])
+        self.center = points[len(points) // 2] if points else 0
+        here = [i for i in intervals if i[0] <= self.center <= i[1]]
+        self.by_start = sorted(here, key=lambda i: i[0])
+        self.by_end = sorted(here, key=lambda i: i[1], reverse=True)
+        left = [i for i in intervals if i[1] < self.center]
+        right = [i for i in intervals if i[0] > self.center]
+        self.left = IntervalTree(left) if left else None
+        self.right = IntervalTree(right) if right else None
+
+    def query(self, point):
+        """
+        Returns values of intervals covering given point.
+        """
+        result = []
+        node = self
+        while node is not None:
+            if point < node.center:
+                for start, _, value in node.by_start:
+                    if start > point:
+                        break
+                    result.append(value)
+                node = node.left
+            else:
+                for _, end, value in node.by_end:
+                    if end < point:
+                        break
+                    result.append(value)
+                node = node.right if point > node.center else None
+        return result
+
+
+@data_cache
+def get_presence_index(year, month):
+    """
+    Builds interval tree of presence seconds for each date of given month.
+
+    It creates structure like this:
+    index = {
+        datetime.date(2013, 10, 1): IntervalTree([
+            (32400, 63000, 'user_id'),
+        ]),
+    }
+    """
+    first = datetime(year, month, 1).date()
+    last = first.replace(day=calendar.monthrange(year, month)[1])
+    intervals = {}
+    for user_id, items in get_data_range(first, last).items():
+        for date in items:
+            if not first <= date <= last:
+                continue
+            start = seconds_since_midnight(items[date]['start'])
+            end = seconds_since_midnight(items[date]['end'])
+            if end < start:
+                continue
+            intervals.setdefault(date, []).append((start, end, user_id))
+    return {date: IntervalTree(items) for date, items in intervals.items()}
+
+
+def present_at(moment):
+    """
+    Returns sorted ids of users present at given datetime.
+    """
+    index = get_presence_index(moment.year, moment.month).get(moment.date())
+    if index is None:
+        return []
+    return sorted(index.query(seconds_since_midnight(moment.time())))
+
+
+class WeeklyTrends(object):
+    """
+    Weekly presence totals and arrivals of users maintained incrementally.
+
+    Weekly buckets are summed per source file, so sync reads again only
+    files changed since previous one and replaces only their buckets.
+    Changed file is summarized whole, so with single DATA_CSV source any
+    new row recomputes all buckets; monthly DATA_DIR partitions limit
+    that to changed months.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sources = {}
+        self.buckets = {}
+        self.weeks = {}
+        self.last_week = None
+
+    def sync(self, sources, load):
+        """
+        Ingests new, changed and removed sources of presence data.
+
+        Sources are (path, version) pairs, `load` returns presence data
+        of path whose version differs from the ingested one.
+        """
+        sources = dict(sources)
+        with self.lock:
+            versions = {path: self.sources[path][0] for path in self.sources}
+        loaded = {
+            path: (version, self.summarize(load(path)))
+            for path, version in sources.items()
+            if versions.get(path) != version
+        }
+        with self.lock:
+            for path in set(self.sources) - set(sources):
+                self.apply(self.sources.pop(path)[1], -1)
+            for path, entry in loaded.items():
+                if path in self.sources:
+                    self.apply(self.sources[path][1], -1)
+                self.apply(entry[1], 1)
+                self.sources[path] = entry
+            last_weeks = [weeks[-1] for weeks in self.weeks.values()]
+            self.last_week = max(last_weeks) if last_weeks else None
+
+    @staticmethod
+    def summarize(data):
+        """
+        Sums presence seconds, arrivals and days of users by week.
+
+        It creates structure like this:
+        summary = {
+            'user_id': {
+                datetime.date(2013, 9, 9): [28800, 32400, 1],
+            }
+        }
+        """
+        summary = {}
+        for user_id, items in data.items():
+            weeks = summary.setdefault(user_id, {})
+            for date in items:
+                week = date - timedelta(days=date.weekday())
+                bucket = weeks.setdefault(week, [0, 0, 0])
+                bucket[0] += interval(items[date]['start'], items[date]['end'])
+                bucket[1] += seconds_since_midnight(items[date]['start'])
+                bucket[2] += 1
+        return summary
+
+    def apply(self, summary, sign):
+        """
+        Adds (sign 1) or subtracts (sign -1) weekly summary of source.
+        """
+        for user_id, weeks in summary.items():
+            buckets = self.buckets.setdefault(user_id, {})
+            for week, values in weeks.items():
+                if week not in buckets:
+                    buckets[week] = [0, 0, 0]
+                    bisect.insort(self.weeks.setdefault(user_id, []), week)
+                bucket = buckets[week]
+                for i, value in enumerate(values):
+                    bucket[i] += sign * value
+                if not bucket[2]:
+                    del buckets[week]
+                    self.weeks[user_id].remove(week)
+            if not buckets:
+                del self.buckets[user_id]
+                self.weeks.pop(user_id, None)
+
+    def series(self, user_id, weeks):
+        """
+        Returns presence hours and mean arrival of user in last weeks.
+        """
+        with self.lock:
+            if user_id not in self.buckets:
+                return []
+            first = self.last_week - timedelta(weeks=weeks - 1)
+            user_weeks = self.weeks[user_id]
+            start = bisect.bisect_left(user_weeks, first)
+            buckets = self.buckets[user_id]
+            present = {week: buckets[week] for week in user_weeks[start:]}
+
+        result = []
+        for i in range(weeks):
+            week = first + timedelta(weeks=i)
+            seconds, arrivals, days = present.get(week, (0, 0, 0))
+            result.append((week.isoformat(), seconds / 3600.0,
+                           float(arrivals) / days if days else 0))
+        return result
+
+
+TRENDS = WeeklyTrends()
+
+
+@data_cache
+def get_trends():
+    """
+    Updates weekly trends with presence data and returns them.
+
+    With DATA_DIR each monthly partition is a separate source, so only
+    changed months are read again, otherwise whole DATA_CSV is read again
+    after each change. Sources versions include users XML modification
+    time, as presence of users without details is skipped.
+    """
+    try:
+        details = os.path.getmtime(app.config['DATA_XML'])
+    except OSError:
+        details = None  # `get_details` tolerates missing XML file too
+    if app.config.get('DATA_DIR'):
+        TRENDS.sync(
+            [(path, (os.path.getmtime(path), details))
+             for _, path in data_partitions()],
+            lambda path: known_users(read_presence(path)),
+        )
+    else:
+        # cached `get_data` may be older than the file modification time
+        path = app.config['DATA_CSV']
+        TRENDS.sync([(path, (os.path.getmtime(path), details))],
+                    lambda path: known_users(read_presence(path)))
+    return TRENDS
+
+
+@data_cache
+def get_weekday_means():
+    """
+    Calculates mean presence time of users by weekday.
+
+    It creates structure like this:
+    means = {
+        'user_id': {
+            0: 30600.0,
+            1: 28800.0,
+        }
+    }
+    Weekdays without presence are omitted.
+    """
+    return {
+        user_id: {
+            weekday: mean(intervals)
+            for weekday, intervals in group_by_weekday(items).items()
+            if intervals
+        }
+        for user_id, items in get_data().items()
+    }
+
+
+@data_cache
+def get_cohorts():
+    """
+    Aggregates weekday means of users in global and configured cohorts.
+
+    It creates structure like this:
+    cohorts = {
+        'all': {
+            'members': set(['user_id']),
+            'means': [30600.0, 28800.0, 0, 0, 0, 0, 0],
+            'sorted': [[27000.0, 30600.0], [28800.0], [], [], [], [], []],
+        }
+    }
+    """
+    means = get_weekday_means()
+    groups = dict(app.config.get('COHORTS', {}))
+    groups[COHORT] = means.keys()
+    cohorts = {}
+    for name, members in groups.items():
+        members = set(members) & set(means)
+        values = [
+            sorted(means[i][weekday] for i in members if weekday in means[i])
+            for weekday in range(7)
+        ]
+        cohorts[name] = {
+            'members': members,
+            'means': [mean(items) for items in values],
+            'sorted': values,
+        }
+    return cohorts
+
+
+def percentile_rank(items, value):
+    """
+    Returns percent of sorted items not greater than value.
+    """
+    if not items:
+        return 0
+    return 100.0 * bisect.bisect_right(items, value) / len(items)
@@ -4,13 +4,17 @@ Defines views.
 """
 
 import calendar
-from flask import redirect, render_template, url_for
+from datetime import datetime
+from json import dumps
+from flask import Response, redirect, render_template, url_for
 
 from presence_analyzer.main import app
 from presence_analyzer.utils import jsonify, get_data, get_details, mean, \
-    group_by_weekday, group_by_weekday_with_points
+    group_by_weekday, group_by_weekday_with_points, get_sketches, \
+    get_team_sketches, percentiles_by_weekday, get_occupancy, present_at, \
+    get_users, data_cache, readiness, get_trends, TREND_WEEKS, \
+    get_weekday_means, get_cohorts, percentile_rank, COHORT
 
-import locale
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
@@ -23,12 +27,20 @@ def mainpage():
     return redirect(url_for('presenceweekday'))
 
 
+@data_cache
+def render_chart(name):
+    """
+    Renders chart page with inlined users list.
+    """
+    return render_template('%s.html' % name, users=get_users(), **{name: True})
+
+
 @app.route('/chart/presenceweekday')
 def presenceweekday():
     """
     Generate view of weekday presence.
     """
-    return render_template('presenceweekday.html', presenceweekday=True)
+    return render_chart('presenceweekday')
 
 
 @app.route('/chart/meantime')
@@ -36,7 +48,7 @@ def meantime():
     """
     Generate view of mean time presence.
     """
-    return render_template('meantime.html', meantime=True)
+    return render_chart('meantime')
 
 
 @app.route('/chart/presencestartend')
@@ -44,7 +56,17 @@ def presencestartend():
     """
     Generate view of start and end presence.
     """
-    return render_template('presencestartend.html', presencestartend=True)
+    return render_chart('presencestartend')
+
+
+@app.route('/health/ready', methods=['GET'])
+def ready_view():
+    """
+    Reports whether presence data is loaded, for load balancer checks.
+    """
+    state = readiness()
+    return Response(dumps(state), status=200 if state['ready'] else 503,
+                    mimetype='application/json')
 
 
 @app.route('/api/v1/users', methods=['GET'])
@@ -53,18 +75,7 @@ def users_view():
     """
     Users listing for dropdown.
     """
-    details = get_details()
-
-    loc = locale.getlocale()
-    locale.setlocale(locale.LC_ALL, 'pl_PL.UTF-8')
-
-    result = [{'user_id': i, 'name': val['name'], 'avatar': val['avatar']}
-              for i, val in details.items()]
-    result.sort(key=lambda k: locale.strxfrm(k['name']))
-
-    locale.setlocale(locale.LC_ALL, loc)
-
-    return result
+    return get_users()
 
 
 @app.route('/api/v1/get_avatar/')
@@ -137,3 +148,144 @@ def presence_start_end(user_id=0):
               for weekday, points in weekdays.items()]
 
     return result
+
+
+@app.route('/api/v1/presence_percentiles/')
+@app.route('/api/v1/presence_percentiles/<int:user_id>', methods=['GET'])
+@jsonify
+def presence_percentiles_view(user_id=0):
+    """
+    Returns median and 90th percentile of start, end and presence time
+    of given user grouped by weekday.
+    """
+    sketches = get_sketches()
+    if user_id not in sketches:
+        log.debug('User %s not found!', user_id)
+        return []
+
+    return percentiles_by_weekday(sketches[user_id])
+
+
+@app.route('/api/v1/team_percentiles', methods=['GET'])
+@jsonify
+def team_percentiles_view():
+    """
+    Returns median and 90th percentile of start, end and presence time
+    of all users grouped by weekday.
+    """
+    return percentiles_by_weekday(get_team_sketches())
+
+
+def occupancy_args(args):
+    """
+    Parses optional `from` and `to` dates (YYYY-MM-DD) and comma
+    separated `users` ids of occupancy filters.
+    """
+    result = {}
+    for key, name in (('from', 'start'), ('to', 'end')):
+        if args.get(key):
+            result[name] = datetime.strptime(args[key], '%Y-%m-%d').date()
+    if args.get('users'):
+        result['users'] = tuple(sorted(
+            set(int(i) for i in args['users'].split(','))
+        ))
+    return result
+
+
+@app.route('/api/v1/occupancy', methods=['GET'])
+@jsonify(query=occupancy_args)
+def occupancy_view(start=None, end=None, users=None):
+    """
+    Returns mean number of present users in 15 minutes slots by weekday.
+
+    Accepts optional `from` and `to` dates (YYYY-MM-DD) and comma
+    separated `users` ids.
+    """
+    return get_occupancy(start, end, users)
+
+
+def present_args(args):
+    """
+    Parses `at` datetime (YYYY-MM-DDTHH:MM:SS).
+    """
+    return {'moment': datetime.strptime(args.get('at', ''),
+                                        '%Y-%m-%dT%H:%M:%S')}
+
+
+@app.route('/api/v1/present', methods=['GET'])
+@jsonify(query=present_args)
+def present_view(moment):
+    """
+    Returns users present at datetime given as `at` (YYYY-MM-DDTHH:MM:SS).
+    """
+    details = get_details()
+    return [{'user_id': i,
+             'name': details[i]['name'],
+             'avatar': details[i]['avatar']}
+            for i in present_at(moment) if i in details]
+
+
+def trend_args(args):
+    """
+    Parses optional number of last `weeks`.
+    """
+    weeks = int(args.get('weeks', TREND_WEEKS))
+    if not 0 < weeks <= 10 * TREND_WEEKS:
+        raise ValueError('Wrong number of weeks: %s' % weeks)
+    return {'weeks': weeks}
+
+
+@app.route('/api/v1/presence_trend/')
+@app.route('/api/v1/presence_trend/<int:user_id>', methods=['GET'])
+@jsonify(query=trend_args)
+def presence_trend_view(user_id=0, weeks=TREND_WEEKS):
+    """
+    Returns weekly presence hours and mean start of given user.
+
+    Accepts optional number of last `weeks` (52 by default).
+    """
+    trends = get_trends()
+    if user_id not in trends.buckets:
+        log.debug('User %s not found!', user_id)
+        return []
+
+    return trends.series(user_id, weeks)
+
+
+def compare_args(args):
+    """
+    Parses optional `cohort` name.
+    """
+    cohort = args.get('cohort', COHORT)
+    if cohort not in get_cohorts():
+        raise ValueError('Unknown cohort: %s' % cohort)
+    return {'cohort': cohort}
+
+
+@app.route('/api/v1/compare/')
+@app.route('/api/v1/compare/<int:user_id>', methods=['GET'])
+@jsonify(query=compare_args)
+def compare_view(user_id=0, cohort=COHORT):
+    """
+    Returns mean presence time of given user by weekday next to mean of
+    cohort and user percentile rank in it.
+
+    Accepts optional `cohort` name from COHORTS setting ('all' by default).
+    """
+    means = get_weekday_means()
+    if user_id not in means:
+        log.debug('User %s not found!', user_id)
+        return []
+
+    cohort = get_cohorts()[cohort]
+    result = []
+    for weekday in range(7):
+        value = means[user_id].get(weekday)
+        result.append((
+            calendar.day_abbr[weekday],
+            value or 0,
+            cohort['means'][weekday],
+            percentile_rank(cohort['sorted'][weekday], value)
+            if value is not None else 0,
+        ))
+    return result